@@ -1,106 +1,249 @@
 import streamlit as st
 import sqlite3
 import pytesseract
-from PIL import Image
+from PIL import Image, ImageOps, ImageStat
 import io
+import hashlib
 import re
 import os
-import tempfile
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid
+import threading
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+
+# Tesseract's OpenMP threading is slower than single-threaded on receipt-sized
+# images; must be set before libtesseract is loaded.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
 
 DB_PATH = 'receipts.db'
 
+# --- Precompiled Parsing Patterns ---
+DATE_RE = re.compile(r'\d{2,4}[\-/]\d{1,2}[\-/]\d{1,4}')
+TOTAL_RE = re.compile(r'(total|amount due|amount)\s*[:\-]?\s*\$?([\d,.]+)', re.IGNORECASE)
+TOTAL_KW_RE = re.compile(r'(total|amount due|amount)', re.IGNORECASE)
+PRICE_RE = re.compile(r'([A-Za-z0-9\s\-]+?)\s+\$?(\d+\.\d{2})')
+DOLLAR_RE = re.compile(r'\$([\d,.]+)')
+MONTH_NUM = {'january': 1, 'february': 2, 'march': 3, 'april': 4, 'may': 5, 'june': 6,
+             'july': 7, 'august': 8, 'september': 9, 'october': 10, 'november': 11, 'december': 12}
+MONTH_RE = re.compile(r'\b(' + '|'.join(MONTH_NUM) + r')\b')
+# Receipt date layouts tried in order; US month-first before day-first.
+DATE_FORMATS = ['%Y-%m-%d', '%Y/%m/%d', '%m/%d/%Y', '%m/%d/%y', '%m-%d-%Y', '%m-%d-%y',
+                '%d/%m/%Y', '%d/%m/%y', '%d-%m-%Y', '%d-%m-%y', '%y-%m-%d', '%y/%m/%d']
+
+# The cookie controller renders a component, so page config has to come first.
+st.set_page_config(page_title="AI Receipt Analyzer", layout="wide")
+
 # --- User UUID Setup ---
+# The ID lives in a browser cookie so it (and every cache keyed on it)
+# survives reloads and new tabs. The cookie is read from the request headers;
+# writing it needs streamlit-cookies-controller.
+try:
+    from streamlit_cookies_controller import CookieController
+except ImportError:
+    CookieController = None
 if 'user_id' not in st.session_state:
-    st.session_state['user_id'] = str(uuid.uuid4())
+    uid = st.context.cookies.get('receipt_uid')
+    if not uid:
+        uid = str(uuid.uuid4())
+        if CookieController is not None:
+            CookieController().set('receipt_uid', uid, max_age=365 * 24 * 3600,
+                                   expires=datetime.now() + timedelta(days=365))
+    st.session_state['user_id'] = uid
 USER_ID = st.session_state['user_id']
 
 # --- Database Setup ---
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    # Check if user_id column exists in receipts
-    c.execute("PRAGMA table_info(receipts)")
-    columns = [col[1] for col in c.fetchall()]
-    if 'user_id' not in columns:
-        c.execute("DROP TABLE IF EXISTS receipts")
-        c.execute("DROP TABLE IF EXISTS items")
-    # Now create tables with user_id
-    c.execute('''CREATE TABLE IF NOT EXISTS receipts (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT,
-        store TEXT,
-        date TEXT,
-        total REAL,
-        image BLOB
-    )''')
-    c.execute('''CREATE TABLE IF NOT EXISTS items (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id TEXT,
-        receipt_id INTEGER,
-        name TEXT,
-        price REAL,
-        FOREIGN KEY(receipt_id) REFERENCES receipts(id)
-    )''')
-    conn.commit()
-    conn.close()
+@st.cache_resource
+def get_conn():
+    # One connection per process, shared across reruns and sessions.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA mmap_size=134217728')
+    conn.row_factory = sqlite3.Row
+    return conn
 
-init_db()
+@st.cache_resource
+def get_db_lock():
+    # Every session thread shares the connection above; hold this around each
+    # use so transactions and cursors from different sessions never interleave.
+    return threading.Lock()
+
+@st.cache_resource
+def init_db():
+    # Schema checks and migrations only need to run once per process.
+    with get_db_lock():
+        conn = get_conn()
+        c = conn.cursor()
+        # Check if user_id column exists in receipts
+        c.execute("PRAGMA table_info(receipts)")
+        columns = [col[1] for col in c.fetchall()]
+        if 'user_id' not in columns:
+            c.execute("DROP TABLE IF EXISTS receipts")
+            c.execute("DROP TABLE IF EXISTS items")
+            c.execute("DROP TABLE IF EXISTS receipts_fts")
+            c.execute("DROP TABLE IF EXISTS items_fts")
+        # Now create tables with user_id
+        c.execute('''CREATE TABLE IF NOT EXISTS receipts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            store TEXT,
+            date TEXT,
+            total REAL,
+            image BLOB
+        )''')
+        c.execute('''CREATE TABLE IF NOT EXISTS items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            receipt_id INTEGER,
+            name TEXT,
+            price REAL,
+            FOREIGN KEY(receipt_id) REFERENCES receipts(id)
+        )''')
+        # Every query filters by user_id; index it together with the usual
+        # ordering/lookup columns.
+        c.execute('CREATE INDEX IF NOT EXISTS idx_receipts_user_date ON receipts(user_id, date DESC)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_items_user_receipt ON items(user_id, receipt_id)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_receipts_user_store ON receipts(user_id, store COLLATE NOCASE)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_items_user_name ON items(user_id, name COLLATE NOCASE)')
+        # Full-text indexes over store and item names, kept in sync by triggers.
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name IN ('receipts_fts', 'items_fts')")
+        existing_fts = {row[0] for row in c.fetchall()}
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS receipts_fts USING fts5(store, content='receipts', content_rowid='id')")
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(name, content='items', content_rowid='id')")
+        for table, column in [('receipts', 'store'), ('items', 'name')]:
+            fts = f'{table}_fts'
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column});
+            END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+            END''')
+            c.execute(f'''CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {column} ON {table} BEGIN
+                INSERT INTO {fts}({fts}, rowid, {column}) VALUES ('delete', old.id, old.{column});
+                INSERT INTO {fts}(rowid, {column}) VALUES (new.id, new.{column});
+            END''')
+            if fts not in existing_fts:
+                c.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+        # One-time rewrite of dates stored before parsing normalized them to
+        # YYYY-MM-DD, so month ranges and the summary still see old receipts.
+        c.execute("PRAGMA user_version")
+        if c.fetchone()[0] < 1:
+            c.execute('BEGIN')
+            c.execute("SELECT id, date FROM receipts WHERE date IS NOT NULL")
+            updates = []
+            for row in c.fetchall():
+                date = _normalize_date(row[1])
+                if date != row[1]:
+                    updates.append((date, row[0]))
+            c.executemany("UPDATE receipts SET date=? WHERE id=?", updates)
+            c.execute("PRAGMA user_version = 1")
+        conn.commit()
+    return True
 
 # --- OCR and Parsing ---
-def extract_text_from_file(uploaded_file):
+def _preprocess_image(image):
+    # Greyscale, cap the resolution and binarize: Tesseract's runtime scales
+    # with pixel count and phone photos are far above the DPI it needs.
+    image = image.convert('L')
+    if max(image.size) > 2000:
+        image.thumbnail((2000, 2000), Image.LANCZOS)
+    image = ImageOps.autocontrast(image)
     try:
-        if uploaded_file.type in ["image/jpeg", "image/png"]:
-            image = Image.open(uploaded_file)
-            text = pytesseract.image_to_string(image)
-            return text
-        elif uploaded_file.type == "application/pdf":
-            try:
-                from pdf2image import convert_from_bytes
-            except ImportError:
-                st.error("Please install pdf2image: pip install pdf2image")
-                return ""
-            images = convert_from_bytes(uploaded_file.read())
-            text = "\n".join([pytesseract.image_to_string(img) for img in images])
+        import cv2
+        import numpy as np
+    except ImportError:
+        threshold = ImageStat.Stat(image).mean[0]
+        return image.point(lambda p: 255 if p > threshold else 0, mode='1')
+    binary = cv2.adaptiveThreshold(np.asarray(image), 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY, 31, 15)
+    return Image.fromarray(binary)
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def _ocr_bytes(key, mime, _data):
+    # Cached on the content digest; the raw bytes are excluded from hashing.
+    if mime in ["image/jpeg", "image/png"]:
+        image = _preprocess_image(Image.open(io.BytesIO(_data)))
+        text = pytesseract.image_to_string(image)
+        return text
+    elif mime == "application/pdf":
+        from pdf2image import convert_from_bytes
+        # 150 DPI greyscale is plenty for Tesseract; with grayscale=True the
+        # default ppm format makes pdftoppm emit uncompressed pgm.
+        images = convert_from_bytes(_data, dpi=150, grayscale=True, thread_count=os.cpu_count() or 1)
+        try:
+            from tesserocr import PyTessBaseAPI
+        except ImportError:
+            # Pages are independent; run one single-threaded tesseract per core.
+            workers = max(1, min(len(images), os.cpu_count() or 1))
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                text = "\n".join(ex.map(pytesseract.image_to_string, images))
             return text
-        else:
-            return ""
+        # Keep one Tesseract instance open across pages instead of paying its
+        # startup cost per page.
+        texts = []
+        with PyTessBaseAPI() as api:
+            for img in images:
+                api.SetImage(img)
+                texts.append(api.GetUTF8Text())
+        text = "\n".join(texts)
+        return text
+    else:
+        return ""
+
+def extract_text_from_file(uploaded_file):
+    data = uploaded_file.getvalue()
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    try:
+        return _ocr_bytes(key, uploaded_file.type, data)
+    except ImportError:
+        st.error("Please install pdf2image: pip install pdf2image")
+        return ""
     except Exception as e:
         st.error(f"OCR extraction failed: {e}")
         return ""
 
+def _normalize_date(raw):
+    # Store dates as YYYY-MM-DD so month queries can use plain range predicates.
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(raw, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return raw
+
 def parse_receipt_text(text):
     lines = [l.strip() for l in text.split('\n') if l.strip()]
-    store = "Unknown"
+    store = None
     date = None
     total = None
     items = []
+    # Single pass: remember the last total/dollar match so the reversed-scan
+    # semantics hold without walking the lines again.
+    last_total = None
+    last_dollar = None
     for l in lines:
-        if not re.search(r'\d{2,4}[\-/]\d{1,2}[\-/]\d{1,4}', l) and not re.search(r'(total|amount due|amount)', l, re.IGNORECASE):
-            store = l
-            break
-    date_regex = r'(\d{2,4}[\-/]\d{1,2}[\-/]\d{1,4})'
-    for l in lines:
-        m = re.search(date_regex, l)
-        if m:
-            date = m.group(1)
-            break
-    total_regex = r'(total|amount due|amount)\s*[:\-]?\s*\$?([\d,.]+)'
-    for l in reversed(lines):
-        m = re.search(total_regex, l, re.IGNORECASE)
+        is_total_line = TOTAL_KW_RE.search(l) is not None
+        # A total line can't be the store name, so only look for a date on it
+        # while the date is still missing.
+        if date is None or (store is None and not is_total_line):
+            m = DATE_RE.search(l)
+            if m:
+                if date is None:
+                    date = m.group(0)
+            elif store is None and not is_total_line:
+                store = l
+        m = DOLLAR_RE.search(l)
         if m:
-            try:
-                total = float(m.group(2).replace(',', ''))
-            except:
-                total = None
-            break
-    price_regex = r'([A-Za-z0-9\s\-]+?)\s+\$?([\d]+\.[\d]{2})'
-    for l in lines:
-        if re.search(r'(total|amount due|amount)', l, re.IGNORECASE):
+            last_dollar = m
+        if is_total_line:
+            m = TOTAL_RE.search(l)
+            if m:
+                last_total = m
             continue
-        m = re.match(price_regex, l)
+        m = PRICE_RE.match(l)
         if m:
             name = m.group(1).strip()
             try:
@@ -109,199 +252,223 @@ def parse_receipt_text(text):
                 price = None
             if name and price is not None:
                 items.append({'name': name, 'price': price})
-    if not date:
-        for l in lines:
-            try:
-                dt = datetime.strptime(l, '%Y-%m-%d')
-                date = l
-                break
-            except:
-                continue
-    if not total:
-        for l in reversed(lines):
-            m = re.search(r'\$([\d,.]+)', l)
-            if m:
-                try:
-                    total = float(m.group(1).replace(',', ''))
-                except:
-                    total = None
-                break
+    if store is None:
+        store = "Unknown"
+    if date:
+        date = _normalize_date(date)
+    if last_total:
+        try:
+            total = float(last_total.group(2).replace(',', ''))
+        except:
+            total = None
+    if not total and last_dollar:
+        try:
+            total = float(last_dollar.group(1).replace(',', ''))
+        except:
+            total = None
     return store, date, total, items
 
+# Runs after the parsing helpers are defined; the date migration uses them.
+init_db()
+
 # --- Database Operations ---
 def insert_receipt(store, date, total, image_bytes, items):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
-    c.execute('INSERT INTO receipts (user_id, store, date, total, image) VALUES (?, ?, ?, ?, ?)',
-              (USER_ID, store, date, total, image_bytes))
-    receipt_id = c.lastrowid
-    for item in items:
-        c.execute('INSERT INTO items (user_id, receipt_id, name, price) VALUES (?, ?, ?, ?)',
-                  (USER_ID, receipt_id, item['name'], item['price']))
-    conn.commit()
-    conn.close()
+    # The connection is in autocommit mode; group the receipt and its items
+    # into one transaction so they cost a single commit. The lock keeps other
+    # sessions out of the transaction and off lastrowid until it commits.
+    with get_db_lock(), conn:
+        c.execute('BEGIN')
+        c.execute('INSERT INTO receipts (user_id, store, date, total, image) VALUES (?, ?, ?, ?, ?)',
+                  (USER_ID, store, date, total, image_bytes))
+        receipt_id = c.lastrowid
+        c.executemany('INSERT INTO items (user_id, receipt_id, name, price) VALUES (?, ?, ?, ?)',
+                      [(USER_ID, receipt_id, item['name'], item['price']) for item in items])
 
 def get_receipts():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT id, store, date, total FROM receipts WHERE user_id=? ORDER BY date DESC', (USER_ID,))
-    rows = c.fetchall()
-    conn.close()
-    return rows
+    conn = get_conn()
+    with get_db_lock():
+        return pd.read_sql_query('SELECT id, store, date, total FROM receipts WHERE user_id=? ORDER BY date DESC',
+                                 conn, params=(USER_ID,))
 
 def get_items_for_receipt(receipt_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('SELECT name, price FROM items WHERE user_id=? AND receipt_id=?', (USER_ID, receipt_id))
-    items = c.fetchall()
-    conn.close()
+    conn = get_conn()
+    with get_db_lock():
+        c = conn.cursor()
+        c.execute('SELECT name, price FROM items WHERE user_id=? AND receipt_id=?', (USER_ID, receipt_id))
+        items = c.fetchall()
     return items
 
 def delete_receipt(receipt_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_conn()
     c = conn.cursor()
-    c.execute('DELETE FROM items WHERE user_id=? AND receipt_id=?', (USER_ID, receipt_id))
-    c.execute('DELETE FROM receipts WHERE user_id=? AND id=?', (USER_ID, receipt_id))
-    conn.commit()
-    conn.close()
+    with get_db_lock(), conn:
+        c.execute('BEGIN')
+        c.execute('DELETE FROM items WHERE user_id=? AND receipt_id=?', (USER_ID, receipt_id))
+        c.execute('DELETE FROM receipts WHERE user_id=? AND id=?', (USER_ID, receipt_id))
 
 def export_receipts_to_csv():
-    conn = sqlite3.connect(DB_PATH)
-    df_receipts = pd.read_sql_query('SELECT * FROM receipts WHERE user_id=?', conn, params=(USER_ID,))
-    df_items = pd.read_sql_query('SELECT * FROM items WHERE user_id=?', conn, params=(USER_ID,))
-    conn.close()
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.csv') as tmp:
-        df_receipts.to_csv(tmp.name, index=False)
-        df_items.to_csv(tmp.name.replace('.csv', '_items.csv'), index=False)
-        return tmp.name, tmp.name.replace('.csv', '_items.csv')
+    conn = get_conn()
+    with get_db_lock():
+        df_receipts = pd.read_sql_query('SELECT id, user_id, store, date, total FROM receipts WHERE user_id=?', conn, params=(USER_ID,))
+        df_items = pd.read_sql_query('SELECT * FROM items WHERE user_id=?', conn, params=(USER_ID,))
+    buf_r = io.BytesIO()
+    df_receipts.to_csv(buf_r, index=False)
+    buf_i = io.BytesIO()
+    df_items.to_csv(buf_i, index=False)
+    return buf_r.getvalue(), buf_i.getvalue()
+
+@st.cache_data(show_spinner=False)
+def _monthly_summary(user_id, cache_key):
+    # cache_key is (row count, max id) so the summary is only rebuilt when the
+    # user's receipts change. Aggregation runs in SQLite on the ISO dates;
+    # rows without a YYYY-MM-DD date are skipped.
+    conn = get_conn()
+    with get_db_lock():
+        summary = pd.read_sql_query(
+            "SELECT substr(date, 1, 7) AS month, SUM(total) AS total FROM receipts "
+            "WHERE user_id=? AND date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-*' "
+            "GROUP BY month ORDER BY month", conn, params=(user_id,))
+        if summary.empty:
+            return None
+        vendor_summary = pd.read_sql_query(
+            "SELECT substr(date, 1, 7) AS month, store, SUM(total) AS total FROM receipts "
+            "WHERE user_id=? AND date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-*' "
+            "GROUP BY month, store ORDER BY month, store", conn, params=(user_id,))
+    return summary, vendor_summary
 
 # --- Improved Rule-based Chat Logic ---
-def answer_query(query):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    q = query.lower()
+def _month_range(year, month):
+    # Half-open [first of month, first of next month) bounds on ISO dates.
+    start = f'{year:04d}-{month:02d}-01'
+    end = f'{year + 1:04d}-01-01' if month == 12 else f'{year:04d}-{month + 1:02d}-01'
+    return start, end
+
+# Each handler gets a cursor and the match of its pattern against the
+# lower-cased query; captured groups carry the vendor/item name.
+def _month_total(c, m):
     now = datetime.now()
-    answer = None
-    # Monthly total
-    if 'this month' in q or 'current month' in q:
-        month = now.strftime('%Y-%m')
-        c.execute("SELECT SUM(total) FROM receipts WHERE user_id=? AND date LIKE ?", (USER_ID, f'{month}%'))
-        total = c.fetchone()[0]
-        answer = f"Total spent this month: ${total:.2f}" if total else "No receipts for this month."
-    # Vendor-specific
-    elif 'from' in q or 'at' in q:
-        for word in ['from', 'at']:
-            if word in q:
-                vendor = q.split(word)[-1].strip().split()[0]
-                c.execute("SELECT date, total, id FROM receipts WHERE user_id=? AND store LIKE ?", (USER_ID, f'%{vendor}%'))
-                rows = c.fetchall()
-                if rows:
-                    total = sum([r[1] for r in rows if r[1]])
-                    answer = f"Total spent at {vendor.title()}: ${total:.2f}\n" + "\n".join([f"{r[0]}: ${r[1]:.2f}" for r in rows])
-                    # List items for this vendor
-                    item_lines = []
-                    for r in rows:
-                        c.execute("SELECT name, price FROM items WHERE user_id=? AND receipt_id=?", (USER_ID, r[2]))
-                        items = c.fetchall()
-                        if items:
-                            item_lines.append(f"Items for {r[0]}: " + ", ".join([f"{i[0]} (${i[1]:.2f})" for i in items]))
-                    if item_lines:
-                        answer += "\n" + "\n".join(item_lines)
-                else:
-                    answer = f"No receipts found for {vendor.title()}."
-                break
-            else:
-                answer = "No matching vendor found."
-    # List all items from last receipt
-    elif 'last receipt' in q or 'latest receipt' in q:
-        c.execute("SELECT id, store, date FROM receipts WHERE user_id=? ORDER BY date DESC LIMIT 1", (USER_ID,))
-        row = c.fetchone()
-        if row:
-            c.execute("SELECT name, price FROM items WHERE user_id=? AND receipt_id=?", (USER_ID, row[0]))
-            items = c.fetchall()
-            if items:
-                answer = f"Items from your last receipt ({row[2]} - {row[1]}):\n" + "\n".join([f"{i[0]}: ${i[1]:.2f}" for i in items])
-            else:
-                answer = "No items found for your last receipt."
-        else:
-            answer = "No receipts found."
-    # What did I buy at [vendor]?
-    elif 'what did i buy at' in q:
-        vendor = q.split('what did i buy at')[-1].strip().split()[0]
-        c.execute("SELECT id, date FROM receipts WHERE user_id=? AND store LIKE ? ORDER BY date DESC", (USER_ID, f'%{vendor}%'))
-        rows = c.fetchall()
-        if rows:
-            all_items = []
-            for r in rows:
-                c.execute("SELECT name, price FROM items WHERE user_id=? AND receipt_id=?", (USER_ID, r[0]))
-                items = c.fetchall()
-                if items:
-                    all_items.extend([f"{i[0]} (${i[1]:.2f}) on {r[1]}" for i in items])
-            if all_items:
-                answer = f"Items bought at {vendor.title()}:\n" + "\n".join(all_items)
-            else:
-                answer = f"No items found for {vendor.title()}."
-        else:
-            answer = f"No receipts found for {vendor.title()}."
-    # How much did I spend on [item]?
-    elif 'how much did i spend on' in q:
-        item = q.split('how much did i spend on')[-1].strip().split()[0]
-        c.execute("SELECT SUM(price) FROM items WHERE user_id=? AND name LIKE ?", (USER_ID, f'%{item}%'))
-        total = c.fetchone()[0]
-        answer = f"Total spent on {item.title()}: ${total:.2f}" if total else f"No purchases found for {item.title()}."
-    # List all items
-    elif 'list all items' in q or 'show all items' in q:
-        c.execute("SELECT name, price, receipt_id FROM items WHERE user_id=?", (USER_ID,))
-        items = c.fetchall()
+    start, end = _month_range(now.year, now.month)
+    c.execute("SELECT SUM(total) FROM receipts WHERE user_id=? AND date >= ? AND date < ?", (USER_ID, start, end))
+    total = c.fetchone()[0]
+    return f"Total spent this month: ${total:.2f}" if total else "No receipts for this month."
+
+def _last_receipt(c, m):
+    c.execute("SELECT id, store, date FROM receipts WHERE user_id=? ORDER BY date DESC LIMIT 1", (USER_ID,))
+    row = c.fetchone()
+    if not row:
+        return "No receipts found."
+    c.execute("SELECT name, price FROM items WHERE user_id=? AND receipt_id=?", (USER_ID, row[0]))
+    items = c.fetchall()
+    if items:
+        return f"Items from your last receipt ({row[2]} - {row[1]}):\n" + "\n".join([f"{i[0]}: ${i[1]:.2f}" for i in items])
+    return "No items found for your last receipt."
+
+def _items_at_vendor(c, m):
+    vendor = m.group(1)
+    c.execute("SELECT r.date, i.id, i.name, i.price FROM receipts r "
+              "LEFT JOIN items i ON i.receipt_id=r.id AND i.user_id=r.user_id "
+              "WHERE r.user_id=? AND r.store LIKE ? ORDER BY r.date DESC, r.id, i.id", (USER_ID, f'%{vendor}%'))
+    rows = c.fetchall()
+    if not rows:
+        return f"No receipts found for {vendor.title()}."
+    all_items = [f"{r[2]} (${r[3]:.2f}) on {r[0]}" for r in rows if r[1] is not None]
+    if all_items:
+        return f"Items bought at {vendor.title()}:\n" + "\n".join(all_items)
+    return f"No items found for {vendor.title()}."
+
+def _spent_on_item(c, m):
+    item = m.group(1)
+    # Quote the term so it is always read as a literal prefix by MATCH.
+    term = '"' + item.replace('"', '""') + '"*'
+    c.execute("SELECT SUM(i.price) FROM items i JOIN items_fts f ON f.rowid=i.id WHERE i.user_id=? AND items_fts MATCH ?", (USER_ID, term))
+    total = c.fetchone()[0]
+    return f"Total spent on {item.title()}: ${total:.2f}" if total else f"No purchases found for {item.title()}."
+
+def _list_items(c, m):
+    c.execute("SELECT i.name, i.price, r.date, r.store FROM items i "
+              "JOIN receipts r ON r.id=i.receipt_id AND r.user_id=i.user_id "
+              "WHERE i.user_id=? ORDER BY i.id", (USER_ID,))
+    items = c.fetchall()
+    if not items:
+        return "No items found."
+    lines = [f"{i[0]}: ${i[1]:.2f} ({i[2]} - {i[3]})" for i in items]
+    return "All items:\n" + "\n".join(lines)
+
+def _vendor_total(c, m):
+    vendor = m.group(1)
+    c.execute("SELECT r.id, r.date, r.total, i.id, i.name, i.price FROM receipts r "
+              "LEFT JOIN items i ON i.receipt_id=r.id AND i.user_id=r.user_id "
+              "WHERE r.user_id=? AND r.store LIKE ? ORDER BY r.id, i.id", (USER_ID, f'%{vendor}%'))
+    rows = c.fetchall()
+    if not rows:
+        return f"No receipts found for {vendor.title()}."
+    receipts = []
+    item_lines = []
+    for _, group in groupby(rows, key=lambda r: r[0]):
+        group = list(group)
+        receipts.append(group[0][1:3])
+        items = [r[4:6] for r in group if r[3] is not None]
         if items:
-            lines = []
-            for i in items:
-                c.execute("SELECT store, date FROM receipts WHERE user_id=? AND id=?", (USER_ID, i[2]))
-                r = c.fetchone()
-                if r:
-                    lines.append(f"{i[0]}: ${i[1]:.2f} ({r[1]} - {r[0]})")
-            answer = "All items:\n" + "\n".join(lines)
-        else:
-            answer = "No items found."
-    # Category/month
-    elif 'grocer' in q or 'supermarket' in q or 'food' in q:
-        month = None
-        for m in ['january','february','march','april','may','june','july','august','september','october','november','december']:
-            if m in q:
-                month = m
-                break
-        if month:
-            month_num = datetime.strptime(month, '%B').month
-            year = now.year
-            c.execute("SELECT SUM(total) FROM receipts WHERE user_id=? AND (store LIKE ? OR store LIKE ? OR store LIKE ?) AND strftime('%m', date) = ? AND strftime('%Y', date) = ?", (USER_ID, '%groc%', '%supermarket%', '%food%', f'{month_num:02d}', str(year)))
-            total = c.fetchone()[0]
-            answer = f"Total groceries in {month.title()}: ${total:.2f}" if total else f"No grocery receipts for {month.title()}."
-        else:
-            c.execute("SELECT SUM(total) FROM receipts WHERE user_id=? AND (store LIKE ? OR store LIKE ? OR store LIKE ?)", (USER_ID, '%groc%', '%supermarket%', '%food%'))
-            total = c.fetchone()[0]
-            answer = f"Total groceries: ${total:.2f}" if total else "No grocery receipts found."
-    # Total
-    elif 'total' in q or 'all' in q or 'everything' in q:
-        c.execute("SELECT SUM(total) FROM receipts WHERE user_id=?", (USER_ID,))
-        total = c.fetchone()[0]
-        answer = f"Total spent: ${total:.2f}" if total else "No receipts found."
-    # List receipts
-    elif 'list' in q or 'show' in q:
-        c.execute("SELECT store, date, total FROM receipts WHERE user_id=? ORDER BY date DESC", (USER_ID,))
-        rows = c.fetchall()
-        if rows:
-            answer = "\n".join([f"{r[1]} - {r[0]}: ${r[2]:.2f}" for r in rows])
-        else:
-            answer = "No receipts found."
-    else:
-        answer = "Sorry, I couldn't understand your question. Try asking about totals, vendors, items, or months."
-    conn.close()
+            item_lines.append(f"Items for {group[0][1]}: " + ", ".join([f"{i[0]} (${i[1]:.2f})" for i in items]))
+    total = sum([r[1] for r in receipts if r[1]])
+    answer = f"Total spent at {vendor.title()}: ${total:.2f}\n" + "\n".join([f"{r[0]}: ${r[1]:.2f}" for r in receipts])
+    # List items for this vendor
+    if item_lines:
+        answer += "\n" + "\n".join(item_lines)
     return answer
 
+def _grocery_total(c, m):
+    month_m = MONTH_RE.search(m.string)
+    if month_m:
+        month = month_m.group(1)
+        month_num = MONTH_NUM[month]
+        start, end = _month_range(datetime.now().year, month_num)
+        c.execute("SELECT SUM(r.total) FROM receipts r JOIN receipts_fts f ON f.rowid=r.id WHERE r.user_id=? AND receipts_fts MATCH ? AND r.date >= ? AND r.date < ?", (USER_ID, 'groc* OR supermarket* OR food*', start, end))
+        total = c.fetchone()[0]
+        return f"Total groceries in {month.title()}: ${total:.2f}" if total else f"No grocery receipts for {month.title()}."
+    c.execute("SELECT SUM(r.total) FROM receipts r JOIN receipts_fts f ON f.rowid=r.id WHERE r.user_id=? AND receipts_fts MATCH ?", (USER_ID, 'groc* OR supermarket* OR food*'))
+    total = c.fetchone()[0]
+    return f"Total groceries: ${total:.2f}" if total else "No grocery receipts found."
+
+def _grand_total(c, m):
+    c.execute("SELECT SUM(total) FROM receipts WHERE user_id=?", (USER_ID,))
+    total = c.fetchone()[0]
+    return f"Total spent: ${total:.2f}" if total else "No receipts found."
+
+def _list_receipts(c, m):
+    c.execute("SELECT store, date, total FROM receipts WHERE user_id=? ORDER BY date DESC", (USER_ID,))
+    rows = c.fetchall()
+    if not rows:
+        return "No receipts found."
+    return "\n".join([f"{r[1]} - {r[0]}: ${r[2]:.2f}" for r in rows])
+
+# Checked in order; the first pattern that matches answers the query.
+QUERY_HANDLERS = [
+    (re.compile(r'\bthis month\b|\bcurrent month\b'), _month_total),
+    (re.compile(r'\blast receipt\b|\blatest receipt\b'), _last_receipt),
+    (re.compile(r'\bwhat did i buy at\s+(\w+)'), _items_at_vendor),
+    (re.compile(r'\bhow much did i spend on\s+(\w+)'), _spent_on_item),
+    (re.compile(r'\b(?:list|show) all items\b'), _list_items),
+    (re.compile(r'\b(?:from|at)\s+(\w+)'), _vendor_total),
+    (re.compile(r'\bgrocer|\bsupermarket|\bfood'), _grocery_total),
+    (re.compile(r'\btotal\b|\ball\b|\beverything\b'), _grand_total),
+    (re.compile(r'\blist\b|\bshow\b'), _list_receipts),
+]
+
+def answer_query(query):
+    q = query.lower()
+    for pattern, handler in QUERY_HANDLERS:
+        m = pattern.search(q)
+        if m:
+            with get_db_lock():
+                return handler(get_conn().cursor(), m)
+    return "Sorry, I couldn't understand your question. Try asking about totals, vendors, items, or months."
+
 # --- Streamlit UI ---
-st.set_page_config(page_title="AI Receipt Analyzer", layout="wide")
 st.title("🧾 AI Receipt Analyzer")
-st.caption(f"Your private session ID: {USER_ID[:8]}... (keep this tab open to access your receipts)")
+st.caption(f"Your private session ID: {USER_ID[:8]}... (stored in a browser cookie so your receipts survive reloads)")
 
 # Sidebar: Upload
 st.sidebar.header("Upload Receipt")
@@ -318,7 +485,7 @@ if uploaded_file:
                 st.sidebar.error("Could not extract any text from the uploaded file. Please try another receipt.")
             else:
                 store, date, total, items = parse_receipt_text(text)
-                image_bytes = uploaded_file.read() if hasattr(uploaded_file, 'read') else None
+                image_bytes = uploaded_file.getvalue()
                 insert_receipt(store, date, total, image_bytes, items)
                 st.sidebar.success(f"Receipt from {store} on {date} uploaded!")
                 st.session_state["last_uploaded_filename"] = uploaded_file.name
@@ -327,32 +494,30 @@ else:
 
 # Sidebar: Export
 if st.sidebar.button("Export Receipts to CSV"):
-    csv_path, items_csv_path = export_receipts_to_csv()
-    with open(csv_path, "rb") as f:
-        st.sidebar.download_button("Download Receipts CSV", f, file_name="receipts.csv")
-    with open(items_csv_path, "rb") as f:
-        st.sidebar.download_button("Download Items CSV", f, file_name="items.csv")
+    csv_bytes, items_csv_bytes = export_receipts_to_csv()
+    st.sidebar.download_button("Download Receipts CSV", data=csv_bytes, file_name="receipts.csv", mime="text/csv")
+    st.sidebar.download_button("Download Items CSV", data=items_csv_bytes, file_name="items.csv", mime="text/csv")
 
 # --- Main: Receipts Table with Item Details ---
 st.subheader("Uploaded Receipts")
 receipts = get_receipts()
-if receipts:
-    df = pd.DataFrame(receipts, columns=["ID", "Vendor", "Date", "Total"])
-    st.dataframe(df, use_container_width=True)
-    for r in receipts:
-        total_str = f"${r[3]:.2f}" if r[3] is not None else "N/A"
-        with st.expander(f"Details for {r[2]} - {r[1]}: {total_str}"):
-            items = get_items_for_receipt(r[0])
+if not receipts.empty:
+    st.dataframe(receipts.rename(columns={"id": "ID", "store": "Vendor", "date": "Date", "total": "Total"}),
+                 use_container_width=True)
+    for r in receipts.itertuples(index=False):
+        total_str = f"${r.total:.2f}" if pd.notna(r.total) else "N/A"
+        with st.expander(f"Details for {r.date} - {r.store}: {total_str}"):
+            items = get_items_for_receipt(r.id)
             if items:
                 st.write(pd.DataFrame(items, columns=["Item", "Price"]))
             else:
                 st.write("No items found for this receipt.")
-    del_id = st.selectbox("Select receipt to delete", ["None"] + [str(r[0]) for r in receipts], key="delete_select")
+    del_id = st.selectbox("Select receipt to delete", ["None"] + receipts['id'].astype(str).tolist(), key="delete_select")
     if del_id != "None":
         if st.button("Delete Selected Receipt", key="delete_btn"):
             delete_receipt(int(del_id))
             st.success("Receipt deleted. Please refresh the page to see the update.")
-    show_id = st.selectbox("Show items for receipt", ["None"] + [str(r[0]) for r in receipts], key="show_select")
+    show_id = st.selectbox("Show items for receipt", ["None"] + receipts['id'].astype(str).tolist(), key="show_select")
     if show_id != "None":
         items = get_items_for_receipt(int(show_id))
         if items:
@@ -372,19 +537,16 @@ if st.button("Ask", key="chat_btn") and user_query:
 
 # --- Monthly Summary ---
 st.subheader("📊 Monthly Expense Summary")
-conn = sqlite3.connect(DB_PATH)
-df = pd.read_sql_query('SELECT date, total, store FROM receipts WHERE user_id=?', conn, params=(USER_ID,))
-conn.close()
-if not df.empty:
-    df['date'] = pd.to_datetime(df['date'], errors='coerce')
-    df = df.dropna(subset=['date'])
-    df['month'] = df['date'].dt.to_period('M')
-    summary = df.groupby('month').agg({'total': 'sum'}).reset_index()
+conn = get_conn()
+with get_db_lock():
+    cache_key = tuple(conn.execute('SELECT COUNT(*), MAX(id) FROM receipts WHERE user_id=?', (USER_ID,)).fetchone())
+monthly = _monthly_summary(USER_ID, cache_key)
+if monthly is not None:
+    summary, vendor_summary = monthly
     st.bar_chart(summary.set_index('month'))
-    vendor_summary = df.groupby(['month', 'store']).agg({'total': 'sum'}).reset_index()
     st.write("### By Vendor/Store")
     st.dataframe(vendor_summary)
 else:
     st.info("No data for summary yet.")
 
-st.caption("Built with Streamlit, pytesseract, and SQLite. Your data is private to this browser session.") 
\ No newline at end of file
+st.caption("Built with Streamlit, pytesseract, and SQLite. Your data is private to this browser.") 
\ No newline at end of file